@@ -1,14 +1,29 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pacsv
+from pandas.api.types import union_categoricals
+import hashlib
+import io
 import json
 import os
+import stat
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+# Copy-on-Write is always on from pandas 3; 2.2 needs it switched on
+if int(pd.__version__.split(".")[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 st.set_page_config(page_title="Advanced MIS + CDR Analytics Tool", layout="wide")
 
 st.title("📊 Advanced MIS + Multi-CDR Analytics Tool")
 st.markdown("Upload MIS → Upload Multiple CDR Files → Use Presets or Manual Filter → Analyze")
 
-st.info("🔒 Files are processed temporarily. Presets are saved locally. No lead data is stored.")
+st.info("🔒 Files are processed temporarily and dropped from memory within an hour. Presets are saved locally. Per-number CDR summaries are cached privately on the server for up to 7 days to speed up re-uploads.")
 
 # =====================================================
 # Preset System (Max 2 Presets)
@@ -26,23 +41,291 @@ def save_presets(presets):
     with open(PRESET_FILE, "w") as f:
         json.dump(presets, f)
 
+# =====================================================
+# CDR Summary Cache
+# =====================================================
+
+CDR_CACHE_DIR = os.path.join(tempfile.gettempdir(), "lead_cache")
+
+# Part of every key; bump whenever the summary's columns or dtypes change
+CDR_CACHE_VERSION = 3
+
+# Summaries not used for this long are deleted
+CDR_CACHE_MAX_AGE = 7 * 24 * 60 * 60
+
+# Parsed uploads and summaries held in server memory, shared across sessions
+MEMORY_CACHE_TTL = 60 * 60
+MEMORY_CACHE_MAX_ENTRIES = 16
+
+def cdr_cache_key(raw, name):
+    digest = hashlib.sha256(f"v{CDR_CACHE_VERSION}{os.path.splitext(name)[1]}".encode())
+    digest.update(raw)
+    return digest.hexdigest()
+
+def prepare_cdr_cache():
+    # Owner-only, since summaries hold per-number call history. makedirs leaves an
+    # existing directory as it is, so a loose one is tightened and one that isn't
+    # ours (or isn't a real directory) is not used at all.
+    os.makedirs(CDR_CACHE_DIR, mode=0o700, exist_ok=True)
+    info = os.lstat(CDR_CACHE_DIR)
+    if not stat.S_ISDIR(info.st_mode):
+        return False
+    if hasattr(os, "getuid"):
+        if info.st_uid != os.getuid():
+            return False
+        if stat.S_IMODE(info.st_mode) != 0o700:
+            os.chmod(CDR_CACHE_DIR, 0o700)
+
+    cutoff = time.time() - CDR_CACHE_MAX_AGE
+    for entry in os.scandir(CDR_CACHE_DIR):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except FileNotFoundError:
+            # Another session removed or replaced it first
+            pass
+    return True
+
+def load_cdr_summary(key):
+    path = os.path.join(CDR_CACHE_DIR, f"{key}.parquet")
+    try:
+        # A hit counts as use, so the age limit only removes idle summaries
+        os.utime(path)
+    except FileNotFoundError:
+        return None
+    return pd.read_parquet(path, engine="pyarrow", memory_map=True)
+
+def save_cdr_summary(key, summary):
+    path = os.path.join(CDR_CACHE_DIR, f"{key}.parquet")
+    # Write then rename so a concurrent session never reads a half-written file
+    summary.to_parquet(path + ".tmp", engine="pyarrow", compression="zstd")
+    os.replace(path + ".tmp", path)
+
+# =====================================================
+# Required Columns
+# =====================================================
+
+REQUIRED_MIS_COLS = [
+    "CorporateName","RequestDate","ContractName","PatientName",
+    "ApplicationId","PolicyNo","Gender","RelationShip","EmailId",
+    "ContactNo","NoOfReschedule","ProviderName","ProviderState"
+]
+
+REQUIRED_CDR_COLS = [
+    "Customer Number",
+    "Call Status",
+    "Disposition Name",
+    "Call Start Date",
+    "Call Start Time"
+]
+
+class MissingColumnError(Exception):
+    # Raised from the cached CDR summary so the page can name the file and column
+    pass
+
+# Low-cardinality text is dictionary-encoded at parse time and arrives as pandas categoricals
+CATEGORY_TYPE = pa.dictionary(pa.int32(), pa.string())
+
+CDR_COLUMN_TYPES = {
+    "Customer Number": pa.string(),
+    "Call Status": CATEGORY_TYPE,
+    "Disposition Name": CATEGORY_TYPE,
+    "Call Start Date": pa.string(),
+    "Call Start Time": pa.string()
+}
+
+CATEGORY_COLS = ["Call Status", "Disposition Name"]
+
+CALL_DATE_COLS = ["First_Call_Date", "Last_Call_Date"]
+
+CDR_DATE_FORMAT = "%Y-%m-%d"
+
+# CSV CDRs above this size are summarised block by block instead of loaded whole
+CDR_STREAM_BYTES = 100 * 1024 * 1024
+CDR_BLOCK_BYTES = 16 * 1024 * 1024
+
+# Rows sent to the browser for the on-page report; the downloads carry everything
+REPORT_PREVIEW_ROWS = 5000
+
 # =====================================================
 # Utility Functions
 # =====================================================
 
-def read_file(file):
-    if file.name.endswith(".csv"):
-        return pd.read_csv(file)
-    return pd.read_excel(file)
+def csv_convert_options(raw, usecols=None, column_types=None):
+    options = pacsv.ConvertOptions(column_types=column_types or {}, strings_can_be_null=True)
+    if usecols:
+        # Only project columns the header actually has, so missing ones reach the caller's checks
+        header = pacsv.open_csv(io.BytesIO(raw)).schema.names
+        options.include_columns = [col for col in usecols if col in header]
+    return options
+
+def read_csv_table(raw, usecols=None, column_types=None):
+    # pyarrow's reader is multithreaded and parses straight into Arrow buffers
+    return pacsv.read_csv(io.BytesIO(raw), convert_options=csv_convert_options(raw, usecols, column_types))
+
+def arrow_to_pandas(table):
+    # Dictionary columns become categoricals; everything else keeps its Arrow dtype
+    return table.to_pandas(types_mapper=lambda t: None if pa.types.is_dictionary(t) else pd.ArrowDtype(t))
+
+def read_excel(raw, usecols=None):
+    # Hand-kept sheets mix numbers and text in one column, which no single Arrow type
+    # holds; calamine's own dtypes are kept and those mixed columns become text
+    df = pd.read_excel(io.BytesIO(raw), engine="calamine", usecols=usecols)
+    mixed = df.columns[df.dtypes == object]
+    return df.astype(dict.fromkeys(mixed, "string[pyarrow]"))
+
+@st.cache_data(show_spinner=False, ttl=MEMORY_CACHE_TTL, max_entries=MEMORY_CACHE_MAX_ENTRIES)
+def read_file(raw, name, usecols=None, categories=()):
+    # Keyed on the uploaded bytes, so widget reruns reuse the parsed frame.
+    # Columns outside usecols are skipped; missing ones are left for the caller to report.
+    columns = (lambda col: col in usecols) if usecols else None
+    if name.endswith(".csv"):
+        df = arrow_to_pandas(read_csv_table(raw, usecols, dict.fromkeys(categories, CATEGORY_TYPE)))
+    else:
+        df = read_excel(raw, usecols=columns)
 
-def clean_phone(series):
+    for col in categories:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    return df
+
+def read_cdr_table(raw, name):
+    # CDRs are read with one fixed text schema so CSV and Excel exports parse alike
+    if name.endswith(".csv"):
+        table = read_csv_table(raw, REQUIRED_CDR_COLS, CDR_COLUMN_TYPES)
+    else:
+        df = read_excel(raw, usecols=lambda col: col in REQUIRED_CDR_COLS)
+        if pd.api.types.is_datetime64_any_dtype(df.get("Call Start Date")):
+            df["Call Start Date"] = df["Call Start Date"].dt.strftime("%Y-%m-%d")
+        table = pa.Table.from_pandas(df, preserve_index=False)
+
+    columns = [col for col in REQUIRED_CDR_COLS if col in table.column_names]
     return (
-        series.astype(str)
-        .str.replace(r"\.0$", "", regex=True)
-        .str.replace(r"\D", "", regex=True)
-        .str[-10:]
+        table.select(columns)
+        .cast(pa.schema([(col, pa.string()) for col in columns]))
+        .cast(pa.schema([(col, CDR_COLUMN_TYPES[col]) for col in columns]))
+    )
+
+def iter_cdr_chunks(raw, name):
+    if name.endswith(".csv") and len(raw) > CDR_STREAM_BYTES:
+        reader = pacsv.open_csv(
+            io.BytesIO(raw),
+            read_options=pacsv.ReadOptions(block_size=CDR_BLOCK_BYTES),
+            convert_options=csv_convert_options(raw, REQUIRED_CDR_COLS, CDR_COLUMN_TYPES)
+        )
+        for batch in reader:
+            yield arrow_to_pandas(batch)
+    else:
+        yield arrow_to_pandas(read_cdr_table(raw, name))
+
+# Trailing ".0" from float-parsed numbers, then every non-digit
+PHONE_PATTERN = r"\.0$|\D"
+
+def clean_phone(series):
+    # Runs in Arrow's vectorised kernels rather than per value in Python
+    digits = pa.array(series.astype("string[pyarrow]"))
+
+    # CDR exports usually hold bare digits already; the regex only runs when something needs stripping
+    if not pc.all(pc.ascii_is_decimal(digits)).as_py():
+        digits = pc.replace_substring_regex(digits, pattern=PHONE_PATTERN, replacement="")
+
+    return pd.Series(
+        pd.array(pc.utf8_slice_codeunits(digits, start=-10), dtype="string[pyarrow]"),
+        index=series.index
+    )
+
+# 24-hour HH:MM:SS only; to_timedelta would misread "02:15:00 PM" as 02:15 and "10" as 10ns
+CDR_TIME_PATTERN = r"([01]?\d|2[0-3]):[0-5]\d:[0-5]\d"
+
+def parse_call_datetime(date, clock):
+    # Date and HH:MM:SS time parse separately, so no combined string is built per row
+    parsed = (
+        pd.to_datetime(date, format=CDR_DATE_FORMAT, errors="coerce", cache=True)
+        + pd.to_timedelta(clock.where(clock.str.fullmatch(CDR_TIME_PATTERN)), errors="coerce")
+    )
+
+    # Rows in any other export format (12-hour clocks included) fall back to inference on the joined text
+    retry = parsed.isna() & date.notna() & clock.notna()
+    if retry.any():
+        parsed[retry] = pd.to_datetime(date[retry] + " " + clock[retry], errors="coerce")
+    return parsed
+
+def attach_last_call(agg, last_idx, rows):
+    # Disposition and status of each phone's latest call, gathered by row label
+    last_call = rows.loc[last_idx, ["Disposition Name","Call Status"]].set_axis(agg.index)
+    return pd.concat([agg, last_call], axis=1)
+
+def summarize_cdr(cdr):
+    # One row per phone, indexed by phone; cached on disk, so it is reused across provider changes and re-uploads
+    cdr = cdr.assign(
+        phone=clean_phone(cdr["Customer Number"]),
+        call_datetime=parse_call_datetime(cdr["Call Start Date"], cdr["Call Start Time"])
+    )
+
+    cdr = cdr.dropna(subset=["phone", "call_datetime"])
+
+    # Compare int category codes instead of status strings; -1 (not found) would match nulls
+    status = cdr["Call Status"].cat
+    answered = status.categories.get_indexer(["Answered"])[0]
+    cdr["_answered"] = ((status.codes.to_numpy() == answered) & (answered >= 0)).view("uint8")
+
+    agg = cdr.groupby("phone", sort=False, observed=True).agg(
+        Total_Attempts=("call_datetime", "size"),
+        Connected_Attempts=("_answered", "sum"),
+        First_Call_Date=("call_datetime", "min"),
+        Last_Call_Date=("call_datetime", "max"),
+        last_idx=("call_datetime", "idxmax")
+    )
+
+    return attach_last_call(agg, agg.pop("last_idx"), cdr)
+
+def combine_summaries(parts):
+    # Partial summaries (one per file or CSV block) reduce the same way the raw calls do
+    if len(parts) == 1:
+        return parts[0]
+
+    stacked = pd.concat(parts).reset_index()
+
+    # concat falls back to object when category sets differ; union keeps the codes.
+    # An all-blank column has empty object categories, so every part is put on object first
+    for col in CATEGORY_COLS:
+        stacked[col] = union_categoricals([
+            part[col].cat.set_categories(part[col].cat.categories.astype(object)) for part in parts
+        ])
+
+    agg = stacked.groupby("phone", sort=False, observed=True).agg(
+        Total_Attempts=("Total_Attempts", "sum"),
+        Connected_Attempts=("Connected_Attempts", "sum"),
+        First_Call_Date=("First_Call_Date", "min"),
+        Last_Call_Date=("Last_Call_Date", "max"),
+        last_idx=("Last_Call_Date", "idxmax")
     )
 
+    return attach_last_call(agg, agg.pop("last_idx"), stacked)
+
+@st.cache_data(show_spinner=False, ttl=MEMORY_CACHE_TTL, max_entries=MEMORY_CACHE_MAX_ENTRIES)
+def summarize_cdr_file(raw, name):
+    # Kept in memory per file, backed by the Parquet cache across restarts;
+    # large CSVs are summarised block by block
+    use_disk = prepare_cdr_cache()
+    cdr_key = cdr_cache_key(raw, name)
+    summary = load_cdr_summary(cdr_key) if use_disk else None
+
+    if summary is None:
+        chunks = []
+        for chunk in iter_cdr_chunks(raw, name):
+            for col in REQUIRED_CDR_COLS:
+                if col not in chunk.columns:
+                    raise MissingColumnError(col)
+
+            chunks.append(summarize_cdr(chunk))
+
+        summary = combine_summaries(chunks)
+        if use_disk:
+            save_cdr_summary(cdr_key, summary)
+
+    return summary
+
 # =====================================================
 # Sidebar Upload
 # =====================================================
@@ -59,20 +342,22 @@ with st.sidebar:
 
 if mis_file and cdr_files:
 
-    mis = read_file(mis_file)
-
-    required_mis_cols = [
-        "CorporateName","RequestDate","ContractName","PatientName",
-        "ApplicationId","PolicyNo","Gender","RelationShip","EmailId",
-        "ContactNo","NoOfReschedule","ProviderName","ProviderState"
-    ]
+    # A CSV can be parsed for ProviderName alone; calamine decodes the whole sheet
+    # regardless, so Excel shares the cached full read that Analyze uses
+    if mis_file.name.endswith(".csv"):
+        mis_providers = read_file(
+            mis_file.getvalue(), mis_file.name,
+            usecols=["ProviderName"], categories=["ProviderName"]
+        )
+    else:
+        mis_providers = read_file(mis_file.getvalue(), mis_file.name, categories=["ProviderName"])
 
-    for col in required_mis_cols:
-        if col not in mis.columns:
-            st.error(f"Missing MIS column: {col}")
-            st.stop()
+    if "ProviderName" not in mis_providers.columns:
+        st.error("Missing MIS column: ProviderName")
+        st.stop()
 
-    provider_list = sorted(mis["ProviderName"].dropna().unique())
+    # The categories are the distinct non-null providers; only those few get sorted
+    provider_list = sorted(mis_providers["ProviderName"].cat.categories)
 
     presets = load_presets()
     preset_names = list(presets.keys())
@@ -133,67 +418,48 @@ if mis_file and cdr_files:
 
         with st.spinner("Processing..."):
 
-            mis_filtered = mis[mis["ProviderName"].isin(selected_providers)].copy()
-            mis_filtered["phone"] = clean_phone(mis_filtered["ContactNo"])
-
-            # Combine all CDR files
-            cdr_list = [read_file(f) for f in cdr_files]
-            cdr = pd.concat(cdr_list, ignore_index=True)
-
-            required_cdr_cols = [
-                "Customer Number",
-                "Call Status",
-                "Disposition Name",
-                "Call Start Date",
-                "Call Start Time"
-            ]
+            # Every MIS column is carried into the report, not just the required ones
+            mis = read_file(mis_file.getvalue(), mis_file.name, categories=["ProviderName"])
 
-            for col in required_cdr_cols:
-                if col not in cdr.columns:
-                    st.error(f"Missing CDR column: {col}")
+            for col in REQUIRED_MIS_COLS:
+                if col not in mis.columns:
+                    st.error(f"Missing MIS column: {col}")
                     st.stop()
 
-            cdr = cdr[required_cdr_cols].copy()
-            cdr["phone"] = clean_phone(cdr["Customer Number"])
-
-            cdr["call_datetime"] = pd.to_datetime(
-                cdr["Call Start Date"].astype(str) + " " +
-                cdr["Call Start Time"].astype(str),
-                errors="coerce"
-            )
-
-            cdr = cdr.dropna(subset=["phone", "call_datetime"])
-
-            # =============================
-            # Analytics Calculations
-            # =============================
-
-            attempt_count = cdr.groupby("phone").size().reset_index(name="Total_Attempts")
-
-            connected = (
-                cdr[cdr["Call Status"] == "Answered"]
-                .groupby("phone")
-                .size()
-                .reset_index(name="Connected_Attempts")
-            )
+            # Gather a per-category flag by code instead of comparing provider strings row by row;
+            # the extra trailing False is what the -1 code of a blank provider lands on
+            providers = mis["ProviderName"].cat
+            accept = np.append(providers.categories.isin(selected_providers), False)
+            mis_filtered = mis[accept[providers.codes.to_numpy()]]
+            mis_filtered = mis_filtered.assign(phone=clean_phone(mis_filtered["ContactNo"]))
+
+            mis_phones = pd.Index(mis_filtered["phone"].dropna().unique())
+
+            # Files summarise independently; pyarrow parsing releases the GIL, so run them side by side
+            with ThreadPoolExecutor(max_workers=min(len(cdr_files), os.cpu_count() or 1)) as pool:
+                futures = [pool.submit(summarize_cdr_file, f.getvalue(), f.name) for f in cdr_files]
+
+            # Keep only numbers in the MIS selection
+            parts = []
+            for f, future in zip(cdr_files, futures):
+                try:
+                    part = future.result()
+                except MissingColumnError as missing:
+                    st.error(f"Missing CDR column in {f.name}: {missing.args[0]}")
+                    st.stop()
 
-            first_call = cdr.groupby("phone")["call_datetime"].min().reset_index(name="First_Call_Date")
-            last_call_date = cdr.groupby("phone")["call_datetime"].max().reset_index(name="Last_Call_Date")
+                parts.append(part[part.index.isin(mis_phones)])
 
-            cdr_sorted = cdr.sort_values("call_datetime", ascending=False)
-            last_disposition = cdr_sorted.drop_duplicates("phone")[["phone","Disposition Name","Call Status"]]
+            summary = combine_summaries(parts)
 
-            # Merge everything
-            final = mis_filtered.merge(attempt_count, on="phone", how="left")
-            final = final.merge(connected, on="phone", how="left")
-            final = final.merge(first_call, on="phone", how="left")
-            final = final.merge(last_call_date, on="phone", how="left")
-            final = final.merge(last_disposition, on="phone", how="left")
+            # Phone is the summary's unique index, so the left join is a single lookup
+            matched = summary.reindex(mis_filtered["phone"])
+            matched.index = mis_filtered.index
+            final = pd.concat([mis_filtered, matched], axis=1).reset_index(drop=True)
 
-            final.fillna({
-                "Total_Attempts":0,
-                "Connected_Attempts":0
-            }, inplace=True)
+            # Only the two count columns need filling; int32 keeps the difference below integral
+            counts = ["Total_Attempts", "Connected_Attempts"]
+            final[counts] = final[counts].fillna(0).astype("int32")
 
             final["NotConnected_Attempts"] = final["Total_Attempts"] - final["Connected_Attempts"]
 
@@ -203,14 +469,16 @@ if mis_file and cdr_files:
 
         st.subheader("📈 Key Insights")
 
+        total_calls = int(final["Total_Attempts"].sum())
+        connected_calls = int(final["Connected_Attempts"].sum())
+        connection_rate = f"{connected_calls / total_calls * 100:.1f}%" if total_calls > 0 else "0%"
+
         col1, col2, col3, col4 = st.columns(4)
 
         col1.metric("Total Leads", len(final))
-        col2.metric("Total Calls", int(final["Total_Attempts"].sum()))
-        col3.metric("Connected Calls", int(final["Connected_Attempts"].sum()))
-        col4.metric("Connection Rate",
-                    f"{(final['Connected_Attempts'].sum() / final['Total_Attempts'].sum() * 100):.1f}%"
-                    if final["Total_Attempts"].sum() > 0 else "0%")
+        col2.metric("Total Calls", total_calls)
+        col3.metric("Connected Calls", connected_calls)
+        col4.metric("Connection Rate", connection_rate)
 
         # =============================
         # Disposition Breakdown
@@ -218,8 +486,9 @@ if mis_file and cdr_files:
 
         st.subheader("📊 Disposition Breakdown")
 
-        dispo_summary = final["Disposition Name"].value_counts().reset_index()
-        dispo_summary.columns = ["Disposition", "Count"]
+        # Categorical value_counts is a bincount over codes; drop dispositions absent from this selection
+        dispositions = final["Disposition Name"].value_counts()
+        dispo_summary = dispositions[dispositions > 0].rename_axis("Disposition").reset_index(name="Count")
 
         st.dataframe(dispo_summary, use_container_width=True)
 
@@ -228,17 +497,39 @@ if mis_file and cdr_files:
         # =============================
 
         st.subheader("📋 Detailed Lead Report")
-        st.dataframe(final, use_container_width=True)
+        st.dataframe(final.head(REPORT_PREVIEW_ROWS), use_container_width=True)
+
+        if len(final) > REPORT_PREVIEW_ROWS:
+            st.caption(f"Showing the first {REPORT_PREVIEW_ROWS:,} of {len(final):,} leads. Download the report for all rows.")
 
         # =============================
         # Download
         # =============================
 
-        csv = final.to_csv(index=False).encode("utf-8")
+        # pyarrow's C++ writer serialises straight to bytes; CDR call times are whole
+        # seconds, so only those two columns drop the writer's fractional part
+        report = pa.Table.from_pandas(final, preserve_index=False)
+        report = report.cast(pa.schema([
+            pa.field(field.name, pa.timestamp("s")) if field.name in CALL_DATE_COLS else field
+            for field in report.schema
+        ]), safe=False)
+
+        csv = pa.BufferOutputStream()
+        pacsv.write_csv(report, csv)
 
         st.download_button(
             "📥 Download Full Analytical Report",
-            csv,
+            csv.getvalue().to_pybytes(),
             "Analytical_Report.csv",
             "text/csv"
         )
+
+        parquet = io.BytesIO()
+        final.to_parquet(parquet, engine="pyarrow", compression="zstd", index=False)
+
+        st.download_button(
+            "📥 Download as Parquet",
+            parquet.getvalue(),
+            "Analytical_Report.parquet",
+            "application/octet-stream"
+        )